@@ -1,6 +1,31 @@
+import asyncio
+from sqlalchemy import inspect, text
 from database import engine
 import models
 
+# Indexes replaced by a wider one in models.py; dropped so MySQL stops maintaining both on every write
+SUPERSEDED_INDEXES = {"attendance": ["ix_attendance_user_clockout_date"]}
+
+async def create_tables():
+    # This command creates all tables defined in models.py
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+        # create_all skips tables that already exist, so add any indexes declared since they were made
+        await conn.run_sync(create_missing_indexes)
+    await engine.dispose()
+
+def create_missing_indexes(sync_conn):
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+    # Dropped after the replacements exist, so a foreign key on user_id always has an index to use
+    inspector = inspect(sync_conn)
+    for table, names in SUPERSEDED_INDEXES.items():
+        existing = {ix["name"] for ix in inspector.get_indexes(table)}
+        for name in names:
+            if name in existing:
+                sync_conn.execute(text(f"DROP INDEX {name} ON {table}"))
+
 print("=" * 50)
 print("Database Initialization")
 print("=" * 50)
@@ -10,15 +35,15 @@ print(f"Database URL: {engine.url}")
 
 print("\nCreating tables...")
 try:
-    # This command creates all tables defined in models.py
-    models.Base.metadata.create_all(bind=engine)
+    asyncio.run(create_tables())
     print("\n✓ Tables created successfully!")
     
-    # List all tables created
-    print("\nTables created:")
-    print("  - users (Main user accounts)")
-    print("  - login_attempts (Authentication audit log)")
-    print("  - challenges (Voice challenges)")
+    # List the tables and indexes models.py declares
+    print("\nTables:")
+    for table in models.Base.metadata.sorted_tables:
+        print(f"  - {table.name}")
+        for index in sorted(table.indexes, key=lambda ix: ix.name):
+            print(f"      index {index.name}")
     
     print("\n" + "=" * 50)
     print("Database initialization complete!")
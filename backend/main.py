@@ -1,31 +1,75 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Request
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from typing import List, Optional
 from pydantic import BaseModel
 import os
-import shutil
+import sys
+import time
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from datetime import datetime, timedelta, time
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer
+from sqlalchemy import func, select, bindparam, update, delete, and_, case
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from slowapi import Limiter
 from slowapi.util import get_remote_address
+from cachetools import TTLCache, LRUCache
+import redis.asyncio as aioredis
 import jwt
 
 load_dotenv()
-from database import get_db, engine
+
+# --- LOGGING ---
+# Request code only enqueues records; a QueueListener thread does the actual stdout writes.
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, logging.StreamHandler(sys.stdout))
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(message)s", handlers=[QueueHandler(_log_queue)])
+_log_listener.start()
+
+logger = logging.getLogger("voice_mfa.api")
+# Separator lines are DEBUG-only: at the default INFO level they are dropped before a record is even built
+BANNER = "=" * 60
+
+from database import get_db, engine, warm_pool, AsyncSessionLocal
 import models
 import utils
 
-models.Base.metadata.create_all(bind=engine)
+# Set REDIS_URL to share rate-limit buckets and challenges across uvicorn workers
+REDIS_URL = os.getenv("REDIS_URL")
 
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI(title="Corporate Voice MFA & Task System")
+limiter = Limiter(key_func=get_remote_address, storage_uri=REDIS_URL or "memory://")
+app = FastAPI(title="Corporate Voice MFA & Task System", default_response_class=ORJSONResponse)
 app.state.limiter = limiter
 
-os.makedirs("uploads", exist_ok=True)
+# Long-running loops (sweepers, the embedding batcher) started at startup. asyncio only keeps
+# weak references to tasks, so they are held here, and cancelled cleanly on shutdown.
+_background_tasks = set()
+
+def start_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+# Schema is created once at deploy time by init_db.py; workers only check connectivity (and fill the pool) on boot
+@app.on_event("startup")
+async def check_database():
+    await warm_pool()
+    logger.info("✅ Database reachable (%s)", engine.dialect.name)
 
 # --- BUSINESS LOGIC CONFIG ---
 WORK_START_HOUR = 9
@@ -35,8 +79,197 @@ FINE_PER_HOUR_REMAINING = 50.0
 # --- JWT & SECURITY ---
 JWT_SECRET = os.getenv("JWT_SECRET_KEY", "dev_secret")
 JWT_ALGORITHM = "HS256"
+ACCESS_TOKEN_TTL_SECONDS = 24 * 3600
+# Only the checks our own HS256 tokens need: signature + exp, and both claims must be present
+_JWT_DECODE_OPTIONS = {"verify_signature": True, "verify_exp": True, "verify_aud": False, "verify_iss": False, "require": ["exp", "sub"]}
 security = HTTPBearer()
 
+# Decoded claims of recently seen tokens, so repeat requests skip the HMAC check + JSON parse.
+# Only successfully verified tokens are stored; entries are re-checked against "exp" on hit.
+_jwt_cache = TTLCache(maxsize=4096, ttl=60)
+
+# Authenticated users by username, detached from their session, so authenticated endpoints
+# skip the users lookup on repeat requests. Role changes / deletions take effect within the TTL.
+_user_cache = TTLCache(maxsize=10000, ttl=60)
+
+# username -> user id. Only hits are cached: users are never renamed or deleted through the API,
+# so a known mapping can't go stale, while "not found" must always be re-checked.
+_user_ids = LRUCache(maxsize=5000)
+
+# --- CHALLENGE STORE ---
+# Challenges are single-use and short-lived, so they live in Redis (expired by SETEX) when
+# REDIS_URL is set, otherwise in a per-process TTL cache keyed by username.
+CHALLENGE_TTL_SECONDS = int(os.getenv("CHALLENGE_EXPIRATION_SECONDS", "300"))
+CHALLENGE_SWEEP_SECONDS = 60
+challenge_cache = TTLCache(maxsize=10000, ttl=CHALLENGE_TTL_SECONDS)
+redis_client = aioredis.Redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+async def store_challenge(username: str, code: str):
+    if redis_client is not None:
+        await redis_client.setex(f"ch:{username}", CHALLENGE_TTL_SECONDS, code)
+    else:
+        challenge_cache[username] = code
+
+async def pop_challenge(username: str) -> Optional[str]:
+    if redis_client is not None:
+        return await redis_client.getdel(f"ch:{username}")
+    return challenge_cache.pop(username, None)
+
+async def _sweep_challenges():
+    while True:
+        await asyncio.sleep(CHALLENGE_SWEEP_SECONDS)
+        challenge_cache.expire()
+
+# Worker threads for blocking calls (bcrypt, etc.) offloaded with asyncio.to_thread
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "32"))
+
+# Audio/ML pipelines get their own small pool: torch already parallelises inside each call,
+# so running more than a few pipelines at once only oversubscribes the CPU.
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "3"))
+audio_executor = ThreadPoolExecutor(max_workers=AUDIO_WORKERS, thread_name_prefix="audio")
+
+@app.on_event("startup")
+async def configure_threadpool():
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREADPOOL_SIZE))
+
+async def run_audio(fn, *args):
+    """Run a blocking audio/ML function on the audio pool"""
+    return await asyncio.get_running_loop().run_in_executor(audio_executor, fn, *args)
+
+# Uploads are pulled from Starlette's spooled file in 1 MiB chunks and rejected with 413 as soon as
+# they pass MAX_FILE_SIZE_MB, instead of reading an arbitrarily large body into memory first.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+async def read_upload(file: UploadFile) -> bytes:
+    if file.size is not None and file.size > utils.MAX_FILE_SIZE_BYTES:
+        raise HTTPException(413, "Audio file too large")
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        buf += chunk
+        if len(buf) > utils.MAX_FILE_SIZE_BYTES:
+            raise HTTPException(413, "Audio file too large")
+    return bytes(buf)
+
+def raise_for_quality(a: utils.AudioAnalysis, sample_index: Optional[int] = None) -> None:
+    """400 for audio that failed the quality gate. Registration samples are named by number;
+    login and clock-out get the retry advice. Silence reports snr 0.0, so it is checked before noise."""
+    if a.is_valid:
+        return
+    if a.is_silent: msg = "No audio detected. Please check your microphone"
+    elif a.is_loud: msg = "Audio is too loud (clipping)"
+    elif a.is_multi: msg = "Multiple speakers detected"
+    elif a.snr < 10: msg = "Too much background noise"
+    else: msg = "Quality issues detected" if sample_index is not None else "Poor audio quality"
+    
+    logger.info("Audio Quality Check FAILED: %s", msg)
+    if sample_index is not None:
+        raise HTTPException(400, f"Sample {sample_index + 1} rejected: {msg}")
+    if a.is_silent:
+        raise HTTPException(400, f"Audio quality issue: {msg}.")
+    raise HTTPException(400, f"Audio quality issue: {msg}. Please find a quieter location.")
+
+# Concurrent embedding requests are coalesced into one padded forward pass through the speaker encoder.
+# The batcher waits at most EMBED_BATCH_WAIT_MS after the first request for others to join.
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "8"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "20"))
+_embed_queue: asyncio.Queue = asyncio.Queue()
+
+async def submit_embed(signal) -> np.ndarray:
+    """Queue an enhanced signal for the speaker encoder and wait for its unit-length embedding"""
+    future = asyncio.get_running_loop().create_future()
+    await _embed_queue.put((signal, future))
+    return await future
+
+def _settle_embeds(batch, work: asyncio.Future):
+    error = work.exception()
+    for i, (_, future) in enumerate(batch):
+        if future.done():
+            continue
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(work.result()[i])
+
+def _fail_embeds(batch):
+    """Shutdown: anything dequeued but not yet encoded, or still queued, errors out instead of hanging"""
+    while not _embed_queue.empty():
+        batch.append(_embed_queue.get_nowait())
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(HTTPException(503, "Server shutting down"))
+
+async def _embedding_batcher():
+    loop = asyncio.get_running_loop()
+    batch = []
+    try:
+        while True:
+            batch = [await _embed_queue.get()]
+            deadline = loop.time() + EMBED_BATCH_WAIT_MS / 1000
+            while len(batch) < EMBED_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_embed_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Shielded: a shutdown cancel lets the batch already handed to the encoder finish and reach its callers
+            work = asyncio.ensure_future(run_audio(utils.get_voice_embeddings_batch, [signal for signal, _ in batch]))
+            try:
+                await asyncio.shield(work)
+            except asyncio.CancelledError:
+                await asyncio.wait([work])
+                raise
+            except Exception:
+                pass
+            finally:
+                if work.done():
+                    _settle_embeds(batch, work)
+            batch = []
+    except asyncio.CancelledError:
+        _fail_embeds(batch)
+        raise
+
+@app.on_event("startup")
+async def start_embedding_batcher():
+    start_background(_embedding_batcher())
+
+# Load the ML models before serving so the first /login doesn't pay the load time
+PREWARM_MODELS = os.getenv("PREWARM_MODELS", "true").lower() == "true"
+
+@app.on_event("startup")
+async def prewarm_models():
+    if PREWARM_MODELS:
+        await asyncio.to_thread(utils.prewarm)
+
+@app.on_event("shutdown")
+async def stop_log_listener():
+    _log_listener.stop()
+
+@app.on_event("startup")
+async def start_challenge_sweeper():
+    if redis_client is None:
+        start_background(_sweep_challenges())
+
+# Abandoned registrations are purged in the background rather than only when the same username retries
+PENDING_SWEEP_SECONDS = 60
+PURGE_EXPIRED_PENDING = delete(models.PendingRegistration).where(models.PendingRegistration.expires_at < bindparam("now"))
+
+async def _sweep_pending_registrations():
+    while True:
+        await asyncio.sleep(PENDING_SWEEP_SECONDS)
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(PURGE_EXPIRED_PENDING, {"now": datetime.utcnow()})
+                await db.commit()
+        except Exception as e:
+            logger.warning("⚠️  Pending registration sweep failed: %s", e)
+
+@app.on_event("startup")
+async def start_pending_sweeper():
+    start_background(_sweep_pending_registrations())
+
 origins = os.getenv("CORS_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173").split(",")
 app.add_middleware(
     CORSMiddleware,
@@ -46,6 +279,75 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- PRECOMPILED QUERIES ---
+# Built once at import so every request reuses the same statement object and its compiled SQL
+USER_AUTH_BY_NAME = select(models.User).options(defer(models.User.voiceprint)).where(models.User.username == bindparam("u"))
+USER_ID_BY_NAME = select(models.User.id).where(models.User.username == bindparam("u"))
+USER_LIST = select(models.User.id, models.User.username, models.User.role, models.User.last_login)
+PENDING_BY_NAME = select(models.PendingRegistration).where(models.PendingRegistration.username == bindparam("u"))
+# /register/init: start (or restart) a pending registration in one statement; a restart clears old samples
+_pending_insert = mysql_insert(models.PendingRegistration).values(
+    username=bindparam("u"), password_hash=bindparam("h"), role=bindparam("r"), expires_at=bindparam("exp")
+)
+UPSERT_PENDING = _pending_insert.on_duplicate_key_update(
+    password_hash=_pending_insert.inserted.password_hash,
+    role=_pending_insert.inserted.role,
+    expires_at=_pending_insert.inserted.expires_at,
+    created_at=func.now(),
+    sample_1_embedding=None,
+    sample_2_embedding=None,
+    sample_3_embedding=None,
+)
+# /login: the user plus today's open attendance row (if any) in a single round trip
+def day_bounds(day):
+    """[start, end) datetimes of a calendar day; range filters on a DateTime column can use an index, DATE() can't"""
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+USER_WITH_OPEN_SHIFT = (
+    select(models.User, models.Attendance)
+    .outerjoin(models.Attendance, and_(
+        models.Attendance.user_id == models.User.id,
+        models.Attendance.clock_in >= bindparam("d0"),
+        models.Attendance.clock_in < bindparam("d1"),
+        models.Attendance.clock_out == None
+    ))
+    .where(models.User.username == bindparam("u"))
+    .limit(1)
+)
+
+# /clock_out: latest open shift, pending task count and the stored voiceprint in a single round trip
+OPEN_SHIFT_FOR_CLOCK_OUT = (
+    select(
+        models.Attendance,
+        select(func.count(models.Task.id)).where(
+            models.Task.user_id == bindparam("uid"),
+            models.Task.is_completed == False
+        ).scalar_subquery().label("pending_tasks"),
+        select(models.User.voiceprint).where(models.User.id == bindparam("uid")).scalar_subquery().label("voiceprint")
+    )
+    .where(models.Attendance.user_id == bindparam("uid"), models.Attendance.clock_out == None)
+    .order_by(models.Attendance.clock_in.desc())
+    .limit(1)
+)
+
+# Successful-login bookkeeping as one UPDATE instead of ORM attribute tracking + flush
+LOGIN_SUCCESS_UPDATE = (
+    update(models.User)
+    .where(models.User.id == bindparam("uid"))
+    .values(failed_attempts=0, locked_until=None, last_login=bindparam("now"))
+    .execution_options(synchronize_session=False)
+)
+LOGIN_SUCCESS_MIGRATE_UPDATE = LOGIN_SUCCESS_UPDATE.values(voiceprint=bindparam("vp"))
+
+async def lookup_user_id(db: AsyncSession, username: str) -> Optional[int]:
+    user_id = _user_ids.get(username)
+    if user_id is None:
+        user_id = (await db.execute(USER_ID_BY_NAME, {"u": username})).scalar()
+        if user_id is not None:
+            _user_ids[username] = user_id
+    return user_id
+
 # --- MODELS ---
 class TaskCreate(BaseModel):
     title: str
@@ -66,134 +368,166 @@ class UploadSampleRequest(BaseModel):
     sample_index: int
 
 # --- HELPERS ---
+async def averify_pin(pin: str, password_hash: str) -> bool:
+    """PIN hashing is deliberately slow; run it on the threadpool so the event loop keeps serving"""
+    return await asyncio.to_thread(utils.verify_pin, pin, password_hash)
+
+async def ahash_pin(pin: str) -> str:
+    return await asyncio.to_thread(utils.hash_pin, pin)
+
 def create_access_token(username: str, role: str) -> str:
     payload = {
         "sub": username,
         "role": role,
-        "exp": datetime.utcnow() + timedelta(hours=24)
+        "exp": int(time.time()) + ACCESS_TOKEN_TTL_SECONDS
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+def decode_access_token(token: str) -> dict:
+    cached = _jwt_cache.get(token)
+    if cached and cached["exp"] > time.time():
+        return cached
+    payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM], options=_JWT_DECODE_OPTIONS)
+    claims = {"sub": payload.get("sub"), "role": payload.get("role"), "exp": payload["exp"]}
+    _jwt_cache[token] = claims
+    return claims
+
+def _token_claims(token: str) -> dict:
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        username = payload.get("sub")
-        user = db.query(models.User).filter(models.User.username == username).first()
+        return decode_access_token(token)
+    except jwt.InvalidTokenError: raise HTTPException(401, "Invalid token")
+
+async def _load_auth_user(db: AsyncSession, username: str) -> models.User:
+    user = _user_cache.get(username)
+    if user is None:
+        user = (await db.execute(USER_AUTH_BY_NAME, {"u": username})).scalar_one_or_none()
         if not user: raise HTTPException(401, "User not found")
-        return user
-    except Exception: raise HTTPException(401, "Invalid token")
+        db.expunge(user)
+        _user_cache[username] = user
+    return user
 
-def get_current_admin(user: models.User = Depends(get_current_user)):
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
+    return await _load_auth_user(db, _token_claims(credentials.credentials)["sub"])
+
+async def get_current_admin(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
+    # One dependency instead of a chain: non-admin tokens are turned away on their claims alone,
+    # and the stored role is still confirmed so a demotion takes effect within the user cache TTL
+    claims = _token_claims(credentials.credentials)
+    if claims.get("role") != "admin": raise HTTPException(403, "Admin privileges required")
+    user = await _load_auth_user(db, claims["sub"])
     if user.role != "admin": raise HTTPException(403, "Admin privileges required")
     return user
 
+def check_account_lockout(user: models.User, now: datetime):
+    if user.locked_until and now < user.locked_until:
+        remaining_seconds = (user.locked_until - now).total_seconds()
+        locked_until_iso = user.locked_until.isoformat() + "Z"
+        logger.info("Result: ACCOUNT LOCKED ❌")
+        logger.debug(BANNER)
+        raise HTTPException(403, f"Account locked. Try again after {int(remaining_seconds)} seconds.|{locked_until_iso}")
+
+async def handle_failed_pin(db: AsyncSession, user: models.User, now: datetime):
+    """Count a wrong PIN, escalating to a timed lockout every 5 failures. Always raises."""
+    user.failed_attempts += 1
+    
+    if user.failed_attempts >= 5:
+        user.lockout_level += 1
+        if user.lockout_level == 1:
+            user.locked_until = now + timedelta(minutes=10)
+        elif user.lockout_level == 2:
+            user.locked_until = now + timedelta(minutes=30)
+        else:
+            user.locked_until = now + timedelta(hours=24)
+        user.failed_attempts = 0
+        await db.commit()
+        
+        remaining_seconds = (user.locked_until - now).total_seconds()
+        locked_until_iso = user.locked_until.isoformat() + "Z"
+        logger.info("Result: ACCOUNT LOCKED (Level %s) ❌", user.lockout_level)
+        logger.debug(BANNER)
+        raise HTTPException(403, f"Too many failed attempts. Account locked for {int(remaining_seconds)} seconds.|{locked_until_iso}")
+    
+    await db.commit()
+    logger.info("Result: PIN MISMATCH ❌ (Attempt %s/5)", user.failed_attempts)
+    logger.debug(BANNER)
+    raise HTTPException(401, "Invalid credentials")
+
 # --- ENDPOINTS ---
 
 @app.post("/get_challenge")
-def get_challenge(payload: ChallengeRequest, db: Session = Depends(get_db)):
-    print(f"\n{'='*60}")
-    print(f"🔐 CHALLENGE REQUEST")
-    print(f"{'='*60}")
-    print(f"Username: {payload.username}")
+async def get_challenge(payload: ChallengeRequest, db: AsyncSession = Depends(get_db)):
+    logger.debug(BANNER)
+    logger.info("🔐 CHALLENGE REQUEST")
+    logger.debug(BANNER)
+    logger.info("Username: %s", payload.username)
+    now = datetime.utcnow()
     
-    user = db.query(models.User).filter(models.User.username == payload.username).first()
+    user = (await db.execute(USER_AUTH_BY_NAME, {"u": payload.username})).scalar_one_or_none()
     
     if not user:
-        print(f"Result: USER NOT FOUND ❌")
-        print(f"{'='*60}\n")
+        logger.info("Result: USER NOT FOUND ❌")
+        logger.debug(BANNER)
         raise HTTPException(401, "Invalid credentials")
     
-    if user.locked_until and datetime.utcnow() < user.locked_until:
-        remaining_seconds = (user.locked_until - datetime.utcnow()).total_seconds()
-        locked_until_iso = user.locked_until.isoformat() + "Z"
-        print(f"Result: ACCOUNT LOCKED ❌")
-        print(f"{'='*60}\n")
-        raise HTTPException(403, f"Account locked. Try again after {int(remaining_seconds)} seconds.|{locked_until_iso}")
+    check_account_lockout(user, now)
     
     if len(payload.pin) != 4 or not payload.pin.isdigit():
-        print(f"Result: INVALID PIN FORMAT ❌")
-        print(f"{'='*60}\n")
+        logger.info("Result: INVALID PIN FORMAT ❌")
+        logger.debug(BANNER)
         raise HTTPException(400, "PIN must be exactly 4 digits")
     
-    if not utils.verify_pin(payload.pin, user.password_hash):
-        user.failed_attempts += 1
-        
-        if user.failed_attempts >= 5:
-            user.lockout_level += 1
-            if user.lockout_level == 1:
-                user.locked_until = datetime.utcnow() + timedelta(minutes=10)
-            elif user.lockout_level == 2:
-                user.locked_until = datetime.utcnow() + timedelta(minutes=30)
-            else:
-                user.locked_until = datetime.utcnow() + timedelta(hours=24)
-            user.failed_attempts = 0
-            db.commit()
-            
-            remaining_seconds = (user.locked_until - datetime.utcnow()).total_seconds()
-            locked_until_iso = user.locked_until.isoformat() + "Z"
-            print(f"Result: ACCOUNT LOCKED (Level {user.lockout_level}) ❌")
-            print(f"{'='*60}\n")
-            raise HTTPException(403, f"Too many failed attempts. Account locked for {int(remaining_seconds)} seconds.|{locked_until_iso}")
-        
-        db.commit()
-        print(f"Result: PIN MISMATCH ❌ (Attempt {user.failed_attempts}/5)")
-        print(f"{'='*60}\n")
-        raise HTTPException(401, "Invalid credentials")
+    if not await averify_pin(payload.pin, user.password_hash):
+        await handle_failed_pin(db, user, now)
     
     user.failed_attempts = 0
     user.locked_until = None
-    db.commit()
+    # Migrate legacy bcrypt hashes to Argon2id now that we hold the plaintext PIN
+    if utils.pin_needs_rehash(user.password_hash):
+        user.password_hash = await ahash_pin(payload.pin)
+        user.salt = utils.PIN_HASH_SCHEME
+        logger.info("🔁 PIN hash upgraded to %s", utils.PIN_HASH_SCHEME)
+    await db.commit()
     
     code = utils.generate_challenge_code()
-    challenge = models.Challenge(username=payload.username, challenge_code=code, expires_at=datetime.utcnow()+timedelta(seconds=300))
-    db.add(challenge)
-    db.commit()
+    await store_challenge(payload.username, code)
     
-    print(f"Challenge Generated: {code}")
-    print(f"Expires At: {challenge.expires_at}")
-    print(f"Result: SUCCESS ✅")
-    print(f"{'='*60}\n")
+    logger.info("Challenge Generated: %s", code)
+    logger.info("Expires At: %s", now + timedelta(seconds=CHALLENGE_TTL_SECONDS))
+    logger.info("Result: SUCCESS ✅")
+    logger.debug(BANNER)
     
-    return {"challenge": code}
+    # Returning the response directly skips FastAPI's jsonable_encoder walk; orjson serialises the dict as is
+    return ORJSONResponse({"challenge": code})
 
 @app.get("/check_username/{username}")
-def check_username(username: str, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if user:
+async def check_username(username: str, db: AsyncSession = Depends(get_db)):
+    if await lookup_user_id(db, username) is not None:
         raise HTTPException(409, "Username already taken")
     return {"status": "available", "message": "Username is available"}
 
 @app.post("/register/init")
-def register_init(payload: RegisterInitRequest, db: Session = Depends(get_db)):
-    print(f"\n{'='*60}")
-    print(f"📝 REGISTRATION INIT")
-    print(f"{'='*60}")
-    print(f"Username: {payload.username}")
+async def register_init(payload: RegisterInitRequest, db: AsyncSession = Depends(get_db)):
+    logger.debug(BANNER)
+    logger.info("📝 REGISTRATION INIT")
+    logger.debug(BANNER)
+    logger.info("Username: %s", payload.username)
     
-    if db.query(models.User).filter(models.User.username == payload.username).first():
+    if await lookup_user_id(db, payload.username) is not None:
         raise HTTPException(400, "Username already exists")
     
     if len(payload.pin) != 4 or not payload.pin.isdigit():
         raise HTTPException(400, "PIN must be exactly 4 digits")
     
-    existing_pending = db.query(models.PendingRegistration).filter(
-        models.PendingRegistration.username == payload.username
-    ).first()
-    if existing_pending:
-        db.delete(existing_pending)
-        db.commit()
-    
-    pending = models.PendingRegistration(
-        username=payload.username,
-        password_hash=utils.hash_pin(payload.pin),
-        role=payload.role,
-        expires_at=datetime.utcnow() + timedelta(minutes=10)
-    )
-    db.add(pending)
-    db.commit()
+    await db.execute(UPSERT_PENDING, {
+        "u": payload.username,
+        "h": await ahash_pin(payload.pin),
+        "r": payload.role,
+        "exp": datetime.utcnow() + timedelta(minutes=10)
+    })
+    await db.commit()
     
-    print(f"Result: INIT SUCCESS ✅")
-    print(f"{'='*60}\n")
+    logger.info("Result: INIT SUCCESS ✅")
+    logger.debug(BANNER)
     
     return {"status": "success", "message": "Registration initialized"}
 
@@ -202,56 +536,45 @@ async def register_upload_sample(
     username: str = Form(...),
     sample_index: int = Form(...),
     file: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    print(f"\n{'='*60}")
-    print(f"📤 UPLOAD SAMPLE {sample_index + 1}")
-    print(f"{'='*60}")
-    print(f"Username: {username}")
+    logger.debug(BANNER)
+    logger.info("📤 UPLOAD SAMPLE %s", sample_index + 1)
+    logger.debug(BANNER)
+    logger.info("Username: %s", username)
     
-    pending = db.query(models.PendingRegistration).filter(
-        models.PendingRegistration.username == username
-    ).first()
+    pending = (await db.execute(PENDING_BY_NAME, {"u": username})).scalar_one_or_none()
     
     if not pending:
         raise HTTPException(404, "Registration session not found. Please start registration again.")
     
     if datetime.utcnow() > pending.expires_at:
-        db.delete(pending)
-        db.commit()
+        await db.delete(pending)
+        await db.commit()
         raise HTTPException(410, "Registration session expired. Please start again.")
     
     if sample_index not in [0, 1, 2]:
         raise HTTPException(400, "Invalid sample index. Must be 0, 1, or 2.")
     
-    temp = f"uploads/pending_{username}_sample_{sample_index}.webm"
-    
     try:
-        with open(temp, "wb") as b:
-            b.write(await file.read())
-        
-        is_valid, snr, is_loud, is_multi, details = utils.check_audio_quality(temp)
-        
-        if not is_valid:
-            msg = "Quality issues detected"
-            if is_loud: msg = "Audio is too loud (clipping)"
-            elif is_multi: msg = "Multiple speakers detected"
-            elif snr < 10: msg = "Too much background noise"
-            
-            print(f"Audio Quality Check FAILED: {msg}")
-            raise HTTPException(400, f"Sample {sample_index + 1} rejected: {msg}")
+        data = await read_upload(file)
         
-        clean = utils.load_and_enhance_audio(temp)
-        if clean is None:
+        # Decode, quality, enhancement and spoof check in one pass on the audio pool
+        a = await run_audio(utils.process_audio, data)
+        if a.samples is None:
             raise HTTPException(400, "Audio processing failed")
         
-        is_real, conf, label = utils.check_spoofing(temp, is_clipped=is_loud)
-        if not is_real:
-            if is_loud and label == "QUALITY_ISSUE":
+        raise_for_quality(a, sample_index)
+        
+        if not a.is_real:
+            if a.is_loud and a.spoof_label == "QUALITY_ISSUE":
                 raise HTTPException(400, "Audio is too loud or distorted. Please move further from the microphone and try again.")
             raise HTTPException(400, "Registration rejected. Synthetic audio detected.")
         
-        embedding = utils.get_voice_embedding(clean)
+        if a.clean is None:
+            raise HTTPException(400, "Audio processing failed")
+        
+        embedding = await submit_embed(a.clean)
         embedding_blob = utils.encrypt_voiceprint(embedding)
         
         if sample_index == 0:
@@ -261,151 +584,146 @@ async def register_upload_sample(
         elif sample_index == 2:
             pending.sample_3_embedding = embedding_blob
         
-        db.commit()
-        os.remove(temp)
+        await db.commit()
         
-        print(f"Result: SAMPLE {sample_index + 1} UPLOADED ✅")
-        print(f"{'='*60}\n")
+        logger.info("Result: SAMPLE %s UPLOADED ✅", sample_index + 1)
+        logger.debug(BANNER)
         
         return {"status": "success", "message": f"Sample {sample_index + 1} uploaded successfully"}
     
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Upload error: {e}")
-        print(f"{'='*60}\n")
-        if os.path.exists(temp):
-            os.remove(temp)
+        logger.error("Upload error: %s", e)
+        logger.debug(BANNER)
         raise HTTPException(500, str(e))
 
 @app.post("/register/finalize")
-def register_finalize(username: str = Form(...), db: Session = Depends(get_db)):
-    print(f"\n{'='*60}")
-    print(f"✅ REGISTRATION FINALIZE")
-    print(f"{'='*60}")
-    print(f"Username: {username}")
+async def register_finalize(username: str = Form(...), db: AsyncSession = Depends(get_db)):
+    logger.debug(BANNER)
+    logger.info("✅ REGISTRATION FINALIZE")
+    logger.debug(BANNER)
+    logger.info("Username: %s", username)
     
-    pending = db.query(models.PendingRegistration).filter(
-        models.PendingRegistration.username == username
-    ).first()
+    pending = (await db.execute(PENDING_BY_NAME, {"u": username})).scalar_one_or_none()
     
     if not pending:
         raise HTTPException(404, "Registration session not found")
     
     if datetime.utcnow() > pending.expires_at:
-        db.delete(pending)
-        db.commit()
+        await db.delete(pending)
+        await db.commit()
         raise HTTPException(410, "Registration session expired")
     
     if not all([pending.sample_1_embedding, pending.sample_2_embedding, pending.sample_3_embedding]):
         raise HTTPException(400, "All 3 samples must be uploaded before finalizing")
     
     try:
-        emb1 = utils.decrypt_voiceprint(pending.sample_1_embedding)
-        emb2 = utils.decrypt_voiceprint(pending.sample_2_embedding)
-        emb3 = utils.decrypt_voiceprint(pending.sample_3_embedding)
+        samples = [pending.sample_1_embedding, pending.sample_2_embedding, pending.sample_3_embedding]
+        emb_buf = np.empty((len(samples), utils.EMB_DIM), dtype=np.float32)
+        for i, blob in enumerate(samples):
+            emb_buf[i] = utils.decrypt_voiceprint(blob)
         
-        avg_emb = np.mean([emb1, emb2, emb3], axis=0)
+        # Store the averaged voiceprint at unit length, like the per-login embeddings
+        avg_emb = utils.normalize_embedding(emb_buf.mean(axis=0))
         final_blob = utils.encrypt_voiceprint(avg_emb)
         
         new_user = models.User(
             username=pending.username,
             password_hash=pending.password_hash,
-            salt="bcrypt",
+            salt=utils.PIN_HASH_SCHEME,
             voiceprint=final_blob,
             role=pending.role
         )
         db.add(new_user)
-        db.delete(pending)
-        db.commit()
+        await db.delete(pending)
+        await db.commit()
+        _user_ids[new_user.username] = new_user.id
         
-        print(f"Result: REGISTRATION COMPLETE ✅")
-        print(f"{'='*60}\n")
+        logger.info("Result: REGISTRATION COMPLETE ✅")
+        logger.debug(BANNER)
         
         return {"status": "success", "message": "Registration completed successfully"}
     
     except Exception as e:
-        print(f"Finalize error: {e}")
-        print(f"{'='*60}\n")
+        logger.error("Finalize error: %s", e)
+        logger.debug(BANNER)
         raise HTTPException(500, str(e))
 
+def _prepare_registration_sample(data: bytes, i: int):
+    """Quality check -> enhance -> spoof check for one sample (runs on a worker thread)"""
+    logger.info("Processing audio sample %s/3...", i+1)
+    
+    a = utils.process_audio(data)
+    if a.samples is None:
+        raise HTTPException(400, "Audio processing failed")
+    
+    raise_for_quality(a, i)
+    
+    if not a.is_real:
+        if a.is_loud and a.spoof_label == "QUALITY_ISSUE":
+            raise HTTPException(400, "Audio is too loud or distorted. Please move further from the microphone and try again.")
+        raise HTTPException(400, "Registration rejected. Synthetic audio detected.")
+    
+    if a.clean is None:
+        raise HTTPException(400, "Audio processing failed")
+    
+    return a.clean
+
 @app.post("/register")
 async def register_user(
     username: str = Form(...),
     pin: str = Form(...),
     role: str = Form("employee"), 
     files: List[UploadFile] = File(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    print(f"\n{'='*60}")
-    print(f"📝 REGISTRATION REQUEST")
-    print(f"{'='*60}")
-    print(f"Username: {username}")
-    print(f"Role: {role}")
-    
-    if db.query(models.User).filter(models.User.username == username).first():
-        print(f"Result: USERNAME EXISTS ❌")
-        print(f"{'='*60}\n")
+    logger.debug(BANNER)
+    logger.info("📝 REGISTRATION REQUEST")
+    logger.debug(BANNER)
+    logger.info("Username: %s", username)
+    logger.info("Role: %s", role)
+    
+    if await lookup_user_id(db, username) is not None:
+        logger.info("Result: USERNAME EXISTS ❌")
+        logger.debug(BANNER)
         raise HTTPException(400, "Username exists")
     
     if len(pin) != 4 or not pin.isdigit():
         raise HTTPException(400, "PIN must be exactly 4 digits")
 
-    embeddings = []
     try:
-        for i, f in enumerate(files):
-            print(f"\nProcessing audio sample {i+1}/3...")
-            temp = f"uploads/{f.filename}"
-            with open(temp, "wb") as b:
-                b.write(await f.read())
-            
-            # --- FIXED AUDIO QUALITY CHECK ---
-            is_valid, snr, is_loud, is_multi, details = utils.check_audio_quality(temp)
-            
-            if not is_valid:
-                msg = "Quality issues detected"
-                if is_loud: msg = "Audio is too loud (clipping)"
-                elif is_multi: msg = "Multiple speakers detected"
-                elif snr < 10: msg = "Too much background noise"
-                
-                print(f"Audio Quality Check FAILED: {msg}")
-                raise HTTPException(400, f"Sample {i+1} rejected: {msg}")
-            
-            clean = utils.load_and_enhance_audio(temp)
-            if clean is None:
-                raise HTTPException(400, "Audio processing failed")
-            
-            is_real, conf, label = utils.check_spoofing(temp, is_clipped=is_loud)
-            if not is_real:
-                if is_loud and label == "QUALITY_ISSUE":
-                    raise HTTPException(400, "Audio is too loud or distorted. Please move further from the microphone and try again.")
-                raise HTTPException(400, "Registration rejected. Synthetic audio detected.")
-
-            embeddings.append(utils.get_voice_embedding(clean))
-            os.remove(temp)
+        async def _one(i, f):
+            data = await read_upload(f)
+            return await run_audio(_prepare_registration_sample, data, i)
         
-        avg_emb = np.mean(embeddings, axis=0)
+        # PIN hashing runs on the default pool alongside the audio work instead of after it
+        password_hash, *cleans = await asyncio.gather(ahash_pin(pin), *[_one(i, f) for i, f in enumerate(files)])
+        
+        # All samples go through the speaker encoder together in one forward pass
+        embs = await run_audio(utils.get_voice_embeddings_batch, cleans)
+        avg_emb = utils.normalize_embedding(embs.mean(axis=0))
         enc_blob = utils.encrypt_voiceprint(avg_emb)
         
         new_user = models.User(
             username=username,
-            password_hash=utils.hash_pin(pin),
-            salt="bcrypt",
+            password_hash=password_hash,
+            salt=utils.PIN_HASH_SCHEME,
             voiceprint=enc_blob,
             role=role
         )
         db.add(new_user)
-        db.commit()
+        await db.commit()
+        _user_ids[username] = new_user.id
         
-        print(f"\nResult: REGISTRATION SUCCESS ✅")
-        print(f"{'='*60}\n")
+        logger.info("Result: REGISTRATION SUCCESS ✅")
+        logger.debug(BANNER)
         return {"status": "success", "message": "User registered"}
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Registration error: {e}")
-        print(f"{'='*60}\n")
-        # Clean up temp file if error occurs
-        if 'temp' in locals() and os.path.exists(temp):
-            os.remove(temp)
+        logger.error("Registration error: %s", e)
+        logger.debug(BANNER)
         raise HTTPException(500, str(e))
 
 @app.post("/login")
@@ -413,206 +731,214 @@ async def login_user(
     username: str = Form(...),
     pin: str = Form(...),
     audio_file: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    print(f"\n{'='*60}")
-    print(f"🔓 LOGIN ATTEMPT")
-    print(f"{'='*60}")
-    print(f"Username: {username}")
+    logger.debug(BANNER)
+    logger.info("🔓 LOGIN ATTEMPT")
+    logger.debug(BANNER)
+    logger.info("Username: %s", username)
+    now = datetime.utcnow()
     
     # 1. Basic Auth
-    user = db.query(models.User).filter(models.User.username == username).first()
+    d0, d1 = day_bounds(now.date())
+    row = (await db.execute(USER_WITH_OPEN_SHIFT, {"u": username, "d0": d0, "d1": d1})).first()
+    user, attendance = row if row else (None, None)
     if not user:
-        print(f"Result: USER NOT FOUND ❌")
-        print(f"{'='*60}\n")
+        logger.info("Result: USER NOT FOUND ❌")
+        logger.debug(BANNER)
         raise HTTPException(401, "Invalid credentials")
     
-    if user.locked_until and datetime.utcnow() < user.locked_until:
-        remaining_seconds = (user.locked_until - datetime.utcnow()).total_seconds()
-        locked_until_iso = user.locked_until.isoformat() + "Z"
-        print(f"Result: ACCOUNT LOCKED ❌")
-        print(f"{'='*60}\n")
-        raise HTTPException(403, f"Account locked. Try again after {int(remaining_seconds)} seconds.|{locked_until_iso}")
+    check_account_lockout(user, now)
     
     if len(pin) != 4 or not pin.isdigit():
-        print(f"Result: INVALID PIN FORMAT ❌")
-        print(f"{'='*60}\n")
+        logger.info("Result: INVALID PIN FORMAT ❌")
+        logger.debug(BANNER)
         raise HTTPException(400, "PIN must be exactly 4 digits")
         
-    if not utils.verify_pin(pin, user.password_hash):
-        user.failed_attempts += 1
-        
-        if user.failed_attempts >= 5:
-            user.lockout_level += 1
-            if user.lockout_level == 1:
-                user.locked_until = datetime.utcnow() + timedelta(minutes=10)
-            elif user.lockout_level == 2:
-                user.locked_until = datetime.utcnow() + timedelta(minutes=30)
-            else:
-                user.locked_until = datetime.utcnow() + timedelta(hours=24)
-            user.failed_attempts = 0
-            db.commit()
-            
-            remaining_seconds = (user.locked_until - datetime.utcnow()).total_seconds()
-            locked_until_iso = user.locked_until.isoformat() + "Z"
-            print(f"Result: ACCOUNT LOCKED (Level {user.lockout_level}) ❌")
-            print(f"{'='*60}\n")
-            raise HTTPException(403, f"Too many failed attempts. Account locked for {int(remaining_seconds)} seconds.|{locked_until_iso}")
-        
-        db.commit()
-        print(f"Result: PIN MISMATCH ❌ (Attempt {user.failed_attempts}/5)")
-        print(f"{'='*60}\n")
-        raise HTTPException(401, "Invalid credentials")
+    if not await averify_pin(pin, user.password_hash):
+        await handle_failed_pin(db, user, now)
+    
+    # Challenges are single-use: consume it now so it cannot be replayed
+    expected_code = await pop_challenge(username)
+    logger.info("Expected Challenge: %s", expected_code)
     
     # 2. Voice Auth
-    temp = f"uploads/login_{username}.webm"
-    with open(temp, "wb") as b:
-        b.write(await audio_file.read())
+    data = await read_upload(audio_file)
     
-    try:
-        # --- FIXED AUDIO QUALITY CHECK ---
-        is_valid, snr, is_loud, is_multi, details = utils.check_audio_quality(temp)
-
-        if not is_valid:
-            msg = "Poor audio quality"
-            if is_loud: msg = "Audio is too loud (clipping)"
-            elif is_multi: msg = "Multiple speakers detected"
-            elif snr < 10: msg = "Too much background noise"
-            
-            raise HTTPException(400, f"Audio quality issue: {msg}. Please find a quieter location.")
-        
-        clean = utils.load_and_enhance_audio(temp)
-        if clean is None: 
-            raise HTTPException(400, "Audio processing failed")
-        
-        is_real, conf, label = utils.check_spoofing(temp, is_clipped=is_loud)
-        if not is_real:
-            if is_loud and label == "QUALITY_ISSUE":
-                raise HTTPException(400, " Spoof detected, If you are a human you should lower the peak of your voice.")
-            raise HTTPException(403, "Spoof detected")
-        
-        login_emb = utils.get_voice_embedding(clean)
-        stored_emb = utils.decrypt_voiceprint(user.voiceprint)
-        score = utils.compare_faces(login_emb, stored_emb)
-        
-        if score < 0.50:
-            print(f"Result: VOICE MISMATCH ❌")
-            print(f"{'='*60}\n")
-            raise HTTPException(401, "Voice mismatch")
-            
-        # Reset failed attempts on successful login
-        user.failed_attempts = 0
-        user.locked_until = None
-        
-        # 3. CLOCK IN LOGIC
-        today = datetime.utcnow().date()
-        attendance = db.query(models.Attendance).filter(
-            models.Attendance.user_id == user.id,
-            func.date(models.Attendance.date) == today,
-            models.Attendance.clock_out == None
-        ).first()
-        
-        if not attendance:
-            attendance = models.Attendance(
-                user_id=user.id,
-                username=user.username,
-                clock_in=datetime.utcnow(),
-                status="Working"
-            )
-            db.add(attendance)
-            db.commit()
-            print(f"✅ User CLOCKED IN at {attendance.clock_in}")
-            
-        token = create_access_token(user.username, user.role)
-        
-        print(f"\nResult: LOGIN SUCCESS ✅")
-        print(f"{'='*60}\n")
-        
-        return {
-            "status": "success",
-            "role": user.role,
-            "token": token,
-            "clock_in_time": attendance.clock_in.isoformat()
-        }
-    finally:
-        if os.path.exists(temp): os.remove(temp)
+    # Decode once; quality and enhancement run in one pass, the spoof check is left to run below
+    a = await run_audio(utils.process_audio, data, False)
+    if a.samples is None:
+        raise HTTPException(400, "Audio processing failed")
+    
+    # --- FIXED AUDIO QUALITY CHECK ---
+    is_loud = a.is_loud
+    raise_for_quality(a)
+
+    if a.clean is None: 
+        raise HTTPException(400, "Audio processing failed")
+
+    # Spoof detection reads the raw samples and the embedding the enhanced signal, so the two
+    # forward passes are independent and run side by side on the audio pool
+    (is_real, conf, label), login_emb = await asyncio.gather(
+        run_audio(utils.check_spoofing, a.samples, is_loud),
+        submit_embed(a.clean)
+    )
+    if not is_real:
+        if is_loud and label == "QUALITY_ISSUE":
+            raise HTTPException(400, " Spoof detected, If you are a human you should lower the peak of your voice.")
+        raise HTTPException(403, "Spoof detected")
+
+    stored_emb = utils.load_voiceprint(user.voiceprint)
+    score = utils.compare_faces(login_emb, stored_emb)
+
+    if score < 0.50:
+        logger.info("Result: VOICE MISMATCH ❌")
+        logger.debug(BANNER)
+        raise HTTPException(401, "Voice mismatch")
+
+    # Reset failed attempts and stamp last_login in a single UPDATE.
+    # Voiceprints stored as pickled float arrays are re-encrypted once, on the next good login.
+    params = {"uid": user.id, "now": now}
+    if utils.voiceprint_is_legacy(user.voiceprint):
+        params["vp"] = utils.encrypt_voiceprint(stored_emb)
+        await db.execute(LOGIN_SUCCESS_MIGRATE_UPDATE, params)
+        logger.info("🔁 Voiceprint migrated to int8 AES-GCM layout")
+    else:
+        await db.execute(LOGIN_SUCCESS_UPDATE, params)
+
+    # 3. CLOCK IN LOGIC (today's open attendance row came back with the user)
+    clocked_in = not attendance
+    if clocked_in:
+        # date keeps its server-side func.now() default, like every existing row; only clock_in is read back
+        attendance = models.Attendance(
+            user_id=user.id,
+            username=user.username,
+            clock_in=now,
+            status="Working"
+        )
+        db.add(attendance)
+    await db.commit()
+    if clocked_in:
+        logger.info("✅ User CLOCKED IN at %s", attendance.clock_in)
+
+    token = create_access_token(user.username, user.role)
+
+    logger.info("Result: LOGIN SUCCESS ✅")
+    logger.debug(BANNER)
+
+    return ORJSONResponse({
+        "status": "success",
+        "role": user.role,
+        "token": token,
+        "clock_in_time": attendance.clock_in.isoformat()
+    })
 
 # --- ADMIN ENDPOINTS ---
 @app.get("/admin/users")
-def get_all_users(admin: models.User = Depends(get_current_admin), db: Session = Depends(get_db)):
-    users = db.query(models.User).all()
+async def get_all_users(admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    users = (await db.execute(USER_LIST)).all()
     return [{"username": u.username, "role": u.role, "id": u.id, "last_login": u.last_login} for u in users]
 
 @app.get("/admin/all_tasks")
-def get_all_tasks(admin: models.User = Depends(get_current_admin), db: Session = Depends(get_db)):
-    return db.query(models.Task).all()
+async def get_all_tasks(admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    return (await db.execute(select(models.Task))).scalars().all()
 
 @app.post("/admin/assign_task")
-def assign_task(task_data: TaskCreate, admin: models.User = Depends(get_current_admin), db: Session = Depends(get_db)):
-    employee = db.query(models.User).filter(models.User.username == task_data.assigned_to_username).first()
-    if not employee: raise HTTPException(404, "Employee not found")
+async def assign_task(task_data: TaskCreate, admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    employee_id = await lookup_user_id(db, task_data.assigned_to_username)
+    if employee_id is None: raise HTTPException(404, "Employee not found")
     
     task = models.Task(
         title=task_data.title, 
         description=task_data.description, 
-        user_id=employee.id,
+        user_id=employee_id,
         assigned_at=datetime.utcnow()
     )
     db.add(task)
-    db.commit()
+    await db.commit()
     return {"message": "Task assigned"}
 
 @app.get("/admin/all_attendance")
-def get_all_attendance(admin: models.User = Depends(get_current_admin), db: Session = Depends(get_db)):
-    return db.query(models.Attendance).all()
+async def get_all_attendance(admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
+    return (await db.execute(select(models.Attendance))).scalars().all()
 
 @app.get("/admin/dashboard_stats")
-def get_dashboard_stats(admin: models.User = Depends(get_current_admin), db: Session = Depends(get_db)):
+async def get_dashboard_stats(admin: models.User = Depends(get_current_admin), db: AsyncSession = Depends(get_db)):
     today = datetime.utcnow().date()
+    week_start = today - timedelta(days=6)
+    today_start, today_end = day_bounds(today)
     
-    active_employees = db.query(models.Attendance).filter(
-        models.Attendance.clock_out == None,
-        func.date(models.Attendance.date) == today
-    ).count()
-    
-    completed_shifts = db.query(models.Attendance).filter(
-        func.date(models.Attendance.date) == today,
-        models.Attendance.clock_out != None
-    ).count()
+    # Today's shifts: open and closed counted in one pass
+    active_employees, completed_shifts = map(int, (await db.execute(select(
+        func.coalesce(func.sum(case((models.Attendance.clock_out == None, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((models.Attendance.clock_out != None, 1), else_=0)), 0)
+    ).where(models.Attendance.date >= today_start, models.Attendance.date < today_end))).one())
     
-    total_tasks = db.query(models.Task).count()
-    completed_tasks = db.query(models.Task).filter(models.Task.is_completed == True).count()
+    # Task totals per user; the overall figures are the sums
+    task_counts = {
+        row.user_id: (row.total, int(row.completed))
+        for row in await db.execute(select(
+            models.Task.user_id,
+            func.count(models.Task.id).label("total"),
+            func.coalesce(func.sum(case((models.Task.is_completed == True, 1), else_=0)), 0).label("completed")
+        ).group_by(models.Task.user_id))
+    }
+    total_tasks = sum(t for t, _ in task_counts.values())
+    completed_tasks = sum(c for _, c in task_counts.values())
     efficiency = round((completed_tasks / total_tasks * 100) if total_tasks > 0 else 0, 2)
     
+    # Last 7 days of attendance grouped by day, pivoted into the graph below
+    day_col = func.date(models.Attendance.date)
+    per_day = {
+        row.day: (row.present, int(row.late))
+        for row in await db.execute(select(
+            day_col.label("day"),
+            func.count(models.Attendance.id).label("present"),
+            func.coalesce(func.sum(case((func.extract('hour', models.Attendance.clock_in) > WORK_START_HOUR, 1), else_=0)), 0).label("late")
+        ).where(models.Attendance.date >= day_bounds(week_start)[0]).group_by(day_col))
+    }
+    
     attendance_graph = []
     for i in range(7):
-        day = today - timedelta(days=6-i)
-        present = db.query(models.Attendance).filter(func.date(models.Attendance.date) == day).count()
-        late_records = db.query(models.Attendance).filter(
-            func.date(models.Attendance.date) == day,
-            func.extract('hour', models.Attendance.clock_in) > WORK_START_HOUR
-        ).count()
+        day = week_start + timedelta(days=i)
+        present, late_records = per_day.get(day, (0, 0))
         attendance_graph.append({
             "date": day.isoformat(),
             "present_count": present,
             "late_count": late_records
         })
     
-    employees = db.query(models.User).filter(models.User.role != "admin").all()
+    employees = (await db.execute(select(models.User.id, models.User.username).where(models.User.role != "admin"))).all()
+    
+    # Today's open shift and the most recent shift for every user, one query each
+    open_today = {}
+    for row in await db.execute(select(models.Attendance.user_id, models.Attendance.clock_in).where(
+        models.Attendance.date >= today_start,
+        models.Attendance.date < today_end,
+        models.Attendance.clock_out == None
+    )):
+        open_today.setdefault(row.user_id, row)
+    
+    latest_clock_in = (
+        select(models.Attendance.user_id, func.max(models.Attendance.clock_in).label("clock_in"))
+        .group_by(models.Attendance.user_id)
+        .subquery()
+    )
+    latest = {}
+    for row in await db.execute(select(
+        models.Attendance.user_id, models.Attendance.clock_in, models.Attendance.clock_out, models.Attendance.fine_amount
+    ).join(latest_clock_in, and_(
+        models.Attendance.user_id == latest_clock_in.c.user_id,
+        models.Attendance.clock_in == latest_clock_in.c.clock_in
+    ))):
+        latest.setdefault(row.user_id, row)
+    
     employee_list = []
     
     for emp in employees:
-        today_attendance = db.query(models.Attendance).filter(
-            models.Attendance.user_id == emp.id,
-            func.date(models.Attendance.date) == today,
-            models.Attendance.clock_out == None
-        ).first()
-        
+        today_attendance = open_today.get(emp.id)
         is_working = today_attendance is not None
-        
-        latest_attendance = db.query(models.Attendance).filter(
-            models.Attendance.user_id == emp.id
-        ).order_by(models.Attendance.clock_in.desc()).first()
+        latest_attendance = latest.get(emp.id)
         
         clock_in_time = None
         clock_out_time = None
@@ -627,11 +953,7 @@ def get_dashboard_stats(admin: models.User = Depends(get_current_admin), db: Ses
             clock_out_time = latest_attendance.clock_out.isoformat() if latest_attendance.clock_out else None
             fine_amount = latest_attendance.fine_amount if latest_attendance.fine_amount else 0.0
         
-        total_tasks = db.query(models.Task).filter(models.Task.user_id == emp.id).count()
-        completed = db.query(models.Task).filter(
-            models.Task.user_id == emp.id,
-            models.Task.is_completed == True
-        ).count()
+        total_tasks, completed = task_counts.get(emp.id, (0, 0))
         
         employee_list.append({
             "id": emp.id,
@@ -655,36 +977,36 @@ def get_dashboard_stats(admin: models.User = Depends(get_current_admin), db: Ses
 
 # --- EMPLOYEE ENDPOINTS ---
 @app.get("/employee/history")
-def get_my_history(user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    history = db.query(models.Attendance).filter(models.Attendance.user_id == user.id)\
-        .order_by(models.Attendance.clock_in.desc()).limit(10).all()
+async def get_my_history(user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    history = (await db.execute(select(models.Attendance).where(models.Attendance.user_id == user.id)\
+        .order_by(models.Attendance.clock_in.desc()).limit(10))).scalars().all()
     return {
         "username": user.username,
         "history": history
     }
 
 @app.get("/employee/tasks")
-def get_my_tasks(user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    return db.query(models.Task).filter(models.Task.user_id == user.id).all()
+async def get_my_tasks(user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    return (await db.execute(select(models.Task).where(models.Task.user_id == user.id))).scalars().all()
 
 @app.put("/employee/complete_task/{task_id}")
-def complete_task(task_id: int, user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    task = db.query(models.Task).filter(models.Task.id == task_id, models.Task.user_id == user.id).first()
+async def complete_task(task_id: int, user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    task = (await db.execute(select(models.Task).where(models.Task.id == task_id, models.Task.user_id == user.id))).scalar_one_or_none()
     if not task: raise HTTPException(404, "Task not found")
     
     task.is_completed = True
     task.completed_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
     return {"message": "Task marked complete"}
 
 # --- CHECK PENDING TASKS (NEW ENDPOINT) ---
 @app.get("/check_pending_tasks")
-def check_pending_tasks(user: models.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def check_pending_tasks(user: models.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     """Check if user has pending tasks before clock out"""
-    pending_count = db.query(models.Task).filter(
+    pending_count = await db.scalar(select(func.count(models.Task.id)).where(
         models.Task.user_id == user.id,
         models.Task.is_completed == False
-    ).count()
+    ))
     
     now = datetime.utcnow()
     today_5pm = now.replace(hour=WORK_END_HOUR, minute=0, second=0, microsecond=0)
@@ -711,104 +1033,99 @@ def check_pending_tasks(user: models.User = Depends(get_current_user), db: Sessi
 async def clock_out(
     audio_file: UploadFile = File(...),
     user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    print(f"\n{'='*60}")
-    print(f"🕐 CLOCK OUT REQUEST")
-    print(f"{'='*60}")
-    print(f"Username: {user.username}")
+    logger.debug(BANNER)
+    logger.info("🕐 CLOCK OUT REQUEST")
+    logger.debug(BANNER)
+    logger.info("Username: %s", user.username)
     
-    attendance = db.query(models.Attendance).filter(
-        models.Attendance.user_id == user.id,
-        models.Attendance.clock_out == None
-    ).order_by(models.Attendance.clock_in.desc()).first()
+    row = (await db.execute(OPEN_SHIFT_FOR_CLOCK_OUT, {"uid": user.id})).first()
     
-    if not attendance:
-        print(f"Result: NOT CLOCKED IN ❌")
-        print(f"{'='*60}\n")
+    if not row:
+        logger.info("Result: NOT CLOCKED IN ❌")
+        logger.debug(BANNER)
         return {"message": "You are not clocked in."}
+    attendance, pending_tasks, voiceprint = row
     
     # Voice verification for clock out
-    temp = f"uploads/clockout_{user.username}.webm"
-    with open(temp, "wb") as b:
-        b.write(await audio_file.read())
+    data = await read_upload(audio_file)
     
-    try:
-        # --- FIXED AUDIO QUALITY CHECK ---
-        is_valid, snr, is_loud, is_multi, details = utils.check_audio_quality(temp)
-        
-        if not is_valid:
-            msg = "Poor audio quality"
-            if is_loud: msg = "Audio is too loud (clipping)"
-            elif is_multi: msg = "Multiple speakers detected"
-            elif snr < 10: msg = "Too much background noise"
+    a = await run_audio(utils.process_audio, data)
+    if a.samples is None:
+        raise HTTPException(400, "Audio processing failed")
+    
+    # --- FIXED AUDIO QUALITY CHECK ---
+    raise_for_quality(a)
 
-            raise HTTPException(400, f"Audio quality issue: {msg}. Please find a quieter location.")
-        
-        clean = utils.load_and_enhance_audio(temp)
-        if clean is None:
-            raise HTTPException(400, "Audio processing failed")
-        
-        is_real, conf, label = utils.check_spoofing(temp, is_clipped=is_loud)
-        if not is_real:
-            if is_loud and label == "QUALITY_ISSUE":
-                raise HTTPException(400, "Audio is too loud or distorted. Please move further from the microphone and try again.")
-            raise HTTPException(403, "Spoof detected")
-        
-        logout_emb = utils.get_voice_embedding(clean)
-        stored_emb = utils.decrypt_voiceprint(user.voiceprint)
-        score = utils.compare_faces(logout_emb, stored_emb)
-        
-        if score < 0.50:
-            print(f"Result: VOICE VERIFICATION FAILED ❌")
-            print(f"{'='*60}\n")
-            raise HTTPException(401, "Voice verification failed for clock out")
-        
-        # Voice verified - proceed with clock out
-        now = datetime.utcnow()
-        attendance.clock_out = now
-        
-        pending_tasks = db.query(models.Task).filter(
-            models.Task.user_id == user.id,
-            models.Task.is_completed == False
-        ).count()
-        
-        today_5pm = now.replace(hour=WORK_END_HOUR, minute=0, second=0, microsecond=0)
-        is_early = now < today_5pm
-        
-        fine = 0.0
-        status = "Shift Completed"
-        
-        if not is_early:
-            status = "Shift Completed (On Time)"
-        elif is_early and pending_tasks == 0:
-            status = "Left Early (Authorized - Work Done)"
-        elif is_early and pending_tasks > 0:
-            hours_remaining = (today_5pm - now).total_seconds() / 3600
-            fine = round(hours_remaining * FINE_PER_HOUR_REMAINING, 2)
-            status = f"Left Early (Fined)"
-        
-        attendance.status = status
-        attendance.fine_amount = fine
-        db.commit()
-        
-        print(f"Clock Out Time: {now}")
-        print(f"Pending Tasks: {pending_tasks}")
-        print(f"Fine Applied: ${fine}")
-        print(f"Status: {status}")
-        print(f"Result: CLOCK OUT SUCCESS ✅")
-        print(f"{'='*60}\n")
-        
-        return {
-            "status": status,
-            "clock_out_time": now.isoformat(),
-            "fine_applied": f"${fine}",
-            "pending_tasks": pending_tasks
-        }
-    finally:
-        if os.path.exists(temp):
-            os.remove(temp)
+    if not a.is_real:
+        if a.is_loud and a.spoof_label == "QUALITY_ISSUE":
+            raise HTTPException(400, "Audio is too loud or distorted. Please move further from the microphone and try again.")
+        raise HTTPException(403, "Spoof detected")
+
+    if a.clean is None:
+        raise HTTPException(400, "Audio processing failed")
+
+    logout_emb = await submit_embed(a.clean)
+    # The cached auth user is loaded without the blob; it came back with the open shift above
+    stored_emb = utils.load_voiceprint(voiceprint)
+    score = utils.compare_faces(logout_emb, stored_emb)
+
+    if score < 0.50:
+        logger.info("Result: VOICE VERIFICATION FAILED ❌")
+        logger.debug(BANNER)
+        raise HTTPException(401, "Voice verification failed for clock out")
+
+    # Voice verified - proceed with clock out
+    now = datetime.utcnow()
+    attendance.clock_out = now
+
+    today_5pm = now.replace(hour=WORK_END_HOUR, minute=0, second=0, microsecond=0)
+    is_early = now < today_5pm
+
+    fine = 0.0
+    status = "Shift Completed"
+
+    if not is_early:
+        status = "Shift Completed (On Time)"
+    elif is_early and pending_tasks == 0:
+        status = "Left Early (Authorized - Work Done)"
+    elif is_early and pending_tasks > 0:
+        hours_remaining = (today_5pm - now).total_seconds() / 3600
+        fine = round(hours_remaining * FINE_PER_HOUR_REMAINING, 2)
+        status = f"Left Early (Fined)"
+
+    attendance.status = status
+    attendance.fine_amount = fine
+    await db.commit()
+
+    logger.info("Clock Out Time: %s", now)
+    logger.info("Pending Tasks: %s", pending_tasks)
+    logger.info("Fine Applied: $%s", fine)
+    logger.info("Status: %s", status)
+    logger.info("Result: CLOCK OUT SUCCESS ✅")
+    logger.debug(BANNER)
+
+    return {
+        "status": status,
+        "clock_out_time": now.isoformat(),
+        "fine_applied": f"${fine}",
+        "pending_tasks": pending_tasks
+    }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    # Each worker is a separate process with its own models and audio pool. Challenges and rate limits
+    # are only shared between workers through Redis, so more than one worker needs REDIS_URL.
+    # loop/http "auto" pick uvloop and httptools when they are installed.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1 and not REDIS_URL:
+        logger.warning("⚠️  WEB_CONCURRENCY=%s without REDIS_URL: challenges won't be shared between workers", workers)
+    uvicorn.run(
+        "main:app" if workers > 1 else app,
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        loop="auto",
+        http="auto"
+    )
@@ -0,0 +1,36 @@
+import asyncio
+from sqlalchemy import select, update
+from database import AsyncSessionLocal, engine
+import models
+import utils
+
+async def migrate_voiceprints():
+    """Re-encrypt every legacy (pickled) voiceprint in the current int8 AES-GCM layout.
+    /login also migrates them one at a time, this just does it for everyone up front."""
+    migrated = failed = 0
+
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(select(models.User.id, models.User.username, models.User.voiceprint))).all()
+        print(f"🔍 Checking {len(rows)} voiceprints...")
+
+        for user_id, username, blob in rows:
+            if not utils.voiceprint_is_legacy(blob):
+                continue
+
+            embedding = utils.decrypt_voiceprint(blob)
+            if embedding is None:
+                print(f"❌ Could not decrypt voiceprint for '{username}', left unchanged")
+                failed += 1
+                continue
+
+            new_blob = utils.encrypt_voiceprint(utils.normalize_embedding(embedding.ravel()))
+            await db.execute(update(models.User).where(models.User.id == user_id).values(voiceprint=new_blob))
+            migrated += 1
+
+        await db.commit()
+
+    print(f"✅ Migrated {migrated} voiceprint(s), {failed} failed")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(migrate_voiceprints())
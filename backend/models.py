@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, LargeBinary, DateTime, ForeignKey, Boolean, Float, Text
+from sqlalchemy import Column, Integer, String, LargeBinary, DateTime, ForeignKey, Boolean, Float, Text, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
@@ -61,6 +61,12 @@ class Attendance(Base):
     status = Column(String(50), default="Working") # Working, Completed, Left Early (Authorized), Left Early (Fined)
     fine_amount = Column(Float, default=0.0)
 
+    # Covers "open shift for user X": today's by clock_in range (login) and the latest by
+    # ORDER BY clock_in DESC (clock out), both as index seeks
+    __table_args__ = (
+        Index("ix_attendance_user_clockout_clockin", "user_id", "clock_out", "clock_in"),
+    )
+
 # --- TASK MANAGEMENT ---
 class Task(Base):
     __tablename__ = "tasks"
@@ -76,6 +82,11 @@ class Task(Base):
 
     assigned_to = relationship("User", back_populates="tasks")
 
+    # Covers per-user pending / completed task counts
+    __table_args__ = (
+        Index("ix_task_user_completed", "user_id", "is_completed"),
+    )
+
 class PendingRegistration(Base):
     __tablename__ = "pending_registrations"
 